@@ -1452,6 +1452,18 @@ def _add_memoryopt_args(parser):
                             'Example A: if tile_factor=1, the qkv layer [hidden, 3* hidden] would be converted into [1,3] tiles of size [hidden,hidden]. '
                             'Example B: if tile_factor=2, the intermediate layer [4*hidden, hidden] will be converted into [8, 2] tiles of size [hidden/2, hidden/2]. '
                             'Default is 1.')
+    group.add_argument("--use-expandable-segments", action="store_true",
+                       help='Switch the PyTorch CUDA caching allocator to expandable '
+                       'segments once the model weights are allocated, to reduce '
+                       'fragmentation from step-to-step varying activation sizes. '
+                       'Also sets TORCH_NCCL_AVOID_RECORD_STREAMS=1 so NCCL '
+                       'collectives do not hold on to freed blocks. Currently '
+                       'honoured by ChatGLM3Model.')
+    group.add_argument("--gpu-mask-threshold", type=int, default=16384,
+                       help='Causal attention masks regenerated for curriculum '
+                       'sequence lengths below this are built directly on the GPU; '
+                       'longer ones are built on the host and copied over '
+                       'asynchronously. Currently honoured by ChatGLM3Model.')
 
     return parser
 
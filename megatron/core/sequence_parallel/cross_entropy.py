@@ -10,20 +10,28 @@ from megatron.core.parallel_state import (
 class _VocabSequenceParallelCrossEntropy(torch.autograd.Function):
 
     @staticmethod
-    def forward(ctx, vocab_seq_parallel_logits, target, label_smoothing=0.0):
+    def forward(ctx, vocab_seq_parallel_logits, target, label_smoothing=0.0, seq_first=True, upcast=False):
         # vocab_seq_parallel_logits: [S/P, B, V]
-        # target: [S/P, B]
-        # return: [S, B]
+        # target: [S/P, B] ([B, S/P] if not seq_first)
+        # return: [S, B] ([B, S] if not seq_first)
 
-        # Need softmax for backward
-        softmax = torch.nn.functional.softmax(vocab_seq_parallel_logits, dim=-1)
+        # The loss all-gather stitches shards along the sequence dimension,
+        # so a batch-first target is handled as a [S/P, B] view.
+        ctx.seq_first = seq_first
+        if not seq_first:
+            target = target.t()
+
+        # Need softmax for backward. With upcast it is computed and kept in
+        # fp32 straight from the half precision logits.
+        softmax = torch.nn.functional.softmax(vocab_seq_parallel_logits, dim=-1,
+                                              dtype=torch.float32 if upcast else None)
         ctx.vocab_size = vocab_seq_parallel_logits.size(2)
-        loss = torch.nn.functional.nll_loss(softmax.log().view(-1, ctx.vocab_size), target.view(-1), reduction='none')
+        loss = torch.nn.functional.nll_loss(softmax.log().view(-1, ctx.vocab_size), target.reshape(-1), reduction='none')
        
         ctx.seqlen = vocab_seq_parallel_logits.size(0) * get_sequence_parallel_world_size()
         batch_size = vocab_seq_parallel_logits.size(1)
 
-        loss_all = torch.empty(ctx.seqlen, batch_size, dtype=vocab_seq_parallel_logits.dtype, device=vocab_seq_parallel_logits.device)
+        loss_all = torch.empty(ctx.seqlen, batch_size, dtype=softmax.dtype, device=vocab_seq_parallel_logits.device)
         if version.parse(torch.__version__) >= version.parse('1.13'):
             torch.distributed.all_gather_into_tensor(loss_all, loss, group=get_sequence_parallel_group())
         else:
@@ -31,11 +39,15 @@ class _VocabSequenceParallelCrossEntropy(torch.autograd.Function):
 
         ctx.save_for_backward(softmax, target)
 
+        if not seq_first:
+            loss_all = loss_all.t().contiguous()
         return loss_all
 
     @staticmethod
     def backward(ctx, grad_output):
         softmax, target = ctx.saved_tensors
+        if not ctx.seq_first:
+            grad_output = grad_output.t()
 
         step_seqlen = ctx.seqlen // get_sequence_parallel_world_size()
         sp_rank = get_sequence_parallel_rank()
@@ -46,11 +58,13 @@ class _VocabSequenceParallelCrossEntropy(torch.autograd.Function):
         arange_1d = torch.arange(start=0, end=grad_2d.size()[0],
                                  device=grad_2d.device)
 
-        grad_2d[arange_1d, target.view(-1)] -= 1
+        grad_2d[arange_1d, target.reshape(-1)] -= 1
         grad_input.mul_(grad_output_part.unsqueeze(dim=-1))
 
-        return grad_input, None, None
+        return grad_input, None, None, None, None
 
 
-def vocab_sequence_parallel_cross_entropy(vocab_parallel_logits, target, label_smoothing=0.0):
-    return _VocabSequenceParallelCrossEntropy.apply(vocab_parallel_logits, target, label_smoothing)
+def vocab_sequence_parallel_cross_entropy(vocab_parallel_logits, target, label_smoothing=0.0, seq_first=True,
+                                          upcast=False):
+    return _VocabSequenceParallelCrossEntropy.apply(vocab_parallel_logits, target, label_smoothing, seq_first,
+                                                    upcast)
@@ -11,17 +11,35 @@ from megatron.core.parallel_state import (
 from .utils import VocabUtility
 
 
+def _target_row_index(vocab_parallel_logits, seq_first):
+    """Rows of the flattened logits in the element order of target."""
+    if seq_first:
+        return torch.arange(start=0, end=vocab_parallel_logits.numel() // vocab_parallel_logits.size(-1),
+                            device=vocab_parallel_logits.device)
+    # Row of the [s*b, v] logits holding token (b, s) is s * batch_size + b,
+    # so enumerating rows in [b, s] order gathers straight into the layout
+    # of a batch-first target without transposing anything.
+    seq_length, batch_size = vocab_parallel_logits.size()[:2]
+    arange_s = torch.arange(start=0, end=seq_length, device=vocab_parallel_logits.device)
+    arange_b = torch.arange(start=0, end=batch_size, device=vocab_parallel_logits.device)
+    return (arange_s.unsqueeze(0) * batch_size + arange_b.unsqueeze(1)).view(-1)
+
+
 class _VocabParallelCrossEntropy(torch.autograd.Function):
 
     @staticmethod
-    def forward(ctx, vocab_parallel_logits, target, label_smoothing=0.0):
+    def forward(ctx, vocab_parallel_logits, target, label_smoothing=0.0, seq_first=True,
+                ignore_index=None, upcast=False):
 
         # Maximum value along vocab dimension across all GPUs.
         logits_max = torch.max(vocab_parallel_logits, dim=-1)[0]
         torch.distributed.all_reduce(logits_max,
                                      op=torch.distributed.ReduceOp.MAX,
                                      group=get_tensor_model_parallel_group())
-        # Subtract the maximum value.
+        # Subtract the maximum value. With upcast, type promotion against
+        # an fp32 maximum makes this the only fp32 copy of the logits.
+        if upcast:
+            logits_max = logits_max.float()
         vocab_parallel_logits = vocab_parallel_logits - logits_max.unsqueeze(dim=-1)
 
         # Get the partition's vocab indecies
@@ -33,6 +51,10 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
             partition_vocab_size, rank, world_size)
 
         # Create a mask of valid vocab ids (1 means it needs to be masked).
+        # Ignored targets fall outside every partition's range as well.
+        if ignore_index is not None:
+            ignore_mask = target == ignore_index
+            target = target.masked_fill(ignore_mask, vocab_end_index)
         target_mask = (target < vocab_start_index) | (target >= vocab_end_index)
         masked_target = target.clone() - vocab_start_index
         masked_target[target_mask] = 0
@@ -42,8 +64,7 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
         # [*, partition-vocab-size] and target to a 1-D tensor of size [*].
         logits_2d = vocab_parallel_logits.view(-1, partition_vocab_size)
         masked_target_1d = masked_target.view(-1)
-        arange_1d = torch.arange(start=0, end=logits_2d.size()[0],
-                                 device=logits_2d.device)
+        arange_1d = _target_row_index(vocab_parallel_logits, seq_first)
         predicted_logits_1d = logits_2d[arange_1d, masked_target_1d]
         predicted_logits_1d = predicted_logits_1d.clone().contiguous()
         predicted_logits = predicted_logits_1d.view_as(target)
@@ -62,7 +83,11 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
                                      group=get_tensor_model_parallel_group())
 
         # Loss = log(sum(exp(logits))) - predicted-logit.
-        loss = torch.log(sum_exp_logits) - predicted_logits
+        # Accumulated in place so the loss keeps the layout of target.
+        log_sum_exp_logits = torch.log(sum_exp_logits)
+        if not seq_first:
+            log_sum_exp_logits = log_sum_exp_logits.t()
+        loss = predicted_logits.neg_().add_(log_sum_exp_logits)
 
         # Normalize and optionally smooth logits
         exp_logits.div_(sum_exp_logits.unsqueeze(dim=-1))
@@ -84,13 +109,21 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
             # Exp logits at this point are normalized probabilities. So we can just take the log to get log-probs.
             log_probs = torch.log(exp_logits)
             mean_log_probs = log_probs.mean(dim=-1)
+            if not seq_first:
+                mean_log_probs = mean_log_probs.t()
             loss = (1.0 - smoothing) * loss - smoothing * mean_log_probs
 
+        # Ignored targets contribute neither loss nor gradient.
+        if ignore_index is not None:
+            loss.masked_fill_(ignore_mask, 0.0)
+        else:
+            ignore_mask = None
+
         ctx.label_smoothing, ctx.vocab_size = label_smoothing, vocab_size
-        ctx.save_for_backward(exp_logits, target_mask, masked_target_1d)
+        ctx.seq_first = seq_first
 
-        # Store softmax, target-mask and masked-target for backward pass.
-        ctx.save_for_backward(exp_logits, target_mask, masked_target_1d)
+        # Store softmax, target-mask, masked-target and ignore-mask for backward pass.
+        ctx.save_for_backward(exp_logits, target_mask, masked_target_1d, ignore_mask)
 
         return loss
 
@@ -98,7 +131,7 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
     def backward(ctx, grad_output):
 
         # Retreive tensors from the forward path.
-        softmax, target_mask, masked_target_1d = ctx.saved_tensors
+        softmax, target_mask, masked_target_1d, ignore_mask = ctx.saved_tensors
         label_smoothing, vocab_size = ctx.label_smoothing, ctx.vocab_size
 
         # All the inputs have softmax as thier gradient.
@@ -108,8 +141,7 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
         grad_2d = grad_input.view(-1, partition_vocab_size)
 
         # Add the gradient from matching classes.
-        arange_1d = torch.arange(start=0, end=grad_2d.size()[0],
-                                 device=grad_2d.device)
+        arange_1d = _target_row_index(softmax, ctx.seq_first)
 
         softmax_update = 1.0 - target_mask.view(-1).float()
 
@@ -122,12 +154,18 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
             grad_2d[arange_1d, masked_target_1d] -= softmax_update
 
         # Finally elementwise multiplication with the output gradients.
+        if ignore_mask is not None:
+            grad_output = grad_output.masked_fill(ignore_mask, 0.0)
+        if not ctx.seq_first:
+            grad_output = grad_output.t()
         grad_input.mul_(grad_output.unsqueeze(dim=-1))
 
-        return grad_input, None, None
+        # With upcast, autograd casts grad_input back to the logits dtype.
+        return grad_input, None, None, None, None, None
 
 
-def vocab_parallel_cross_entropy(vocab_parallel_logits, target, label_smoothing=0.0):
+def vocab_parallel_cross_entropy(vocab_parallel_logits, target, label_smoothing=0.0, seq_first=True,
+                                 ignore_index=None, upcast=False):
     """
     Performs cross entropy loss when logits are split across tensor parallel ranks
 
@@ -139,5 +177,16 @@ def vocab_parallel_cross_entropy(vocab_parallel_logits, target, label_smoothing=
 
         lobal_smoothing: smoothing factor, must be in range [0.0, 1.0)
                          default is no smoothing (=0.0)
+
+        seq_first: if False, target (and the returned loss) is laid out as
+                   [micro_batch_size, sequence_length] while the logits stay
+                   [sequence_length, batch_size, hidden_size]
+
+        ignore_index: target value whose positions yield zero loss and zero
+                      gradient, default is to ignore nothing (=None)
+
+        upcast: if True, half precision logits are reduced in fp32 without
+                first materializing an fp32 copy of them
     """
-    return _VocabParallelCrossEntropy.apply(vocab_parallel_logits, target, label_smoothing)
+    return _VocabParallelCrossEntropy.apply(vocab_parallel_logits, target, label_smoothing, seq_first,
+                                            ignore_index, upcast)
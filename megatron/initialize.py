@@ -223,6 +223,10 @@ def _initialize_distributed():
 
             get_accelerator().set_device(device) # only do so when device_count > 0
 
+    # NCCL process groups read this when they are created.
+    if args.use_expandable_segments:
+        os.environ.setdefault('TORCH_NCCL_AVOID_RECORD_STREAMS', '1')
+
     # Call the init process
     if args.deepspeed or args.ds_inference:
         deepspeed.init_distributed()
@@ -2,6 +2,9 @@
 
 """ChatGLM-3 model."""
 
+import functools
+import re
+
 import torch
 
 from megatron import get_args
@@ -18,6 +21,7 @@ from megatron.model import LayerNorm
 from .language_model import EmbeddingPipe
 from .transformer import ParallelTransformerLayerPipe, LMHeadPipe
 from deepspeed.pipe import PipelineModule, LayerSpec, TiedLayerSpec
+from deepspeed.accelerator import get_accelerator
 
 try:
     from apex.normalization import MixedFusedRMSNorm
@@ -36,32 +40,82 @@ except ImportError:
     DS_UNIVERSAL_CHECKPOINT_INFO = False  
 
 
+def _union_pattern(patterns):
+    """Join regex patterns into a single alternation.
+
+    DeepSpeed matches every parameter name against each pattern of a
+    universal checkpoint category, so one alternation per category keeps
+    that to a single match per name.
+    """
+    return re.compile("|".join(f"(?:{pattern})" for pattern in dict.fromkeys(patterns))).pattern
+
+
+_VOCABULARY_PARAMETER_PATTERN = _union_pattern([
+    r"tied_modules.embed.word_embeddings.weight",
+])
+
+_TP_REPLICATED_PARAMETER_PATTERN = _union_pattern([
+    r"tied_modules.embed.position_embeddings.weight",
+    r"\d+.input_layernorm.weight",
+    r"\d+.input_layernorm.bias",
+    r"\d+.post_attention_layernorm.weight",
+    r"\d+.post_attention_layernorm.bias",
+    r"\d+.self_attention.dense.bias",
+    r"\d+.mlp.dense_4h_to_h.bias",
+    r"\d+.weight",
+    r"\d+.bias",
+])
+
+_PARAMETER_WITH_ROW_PARALLELISM_PATTERN = _union_pattern([
+    r"\d+.mlp.dense_4h_to_h.weight",
+    r"\d+.self_attention.dense.weight",
+])
+
+
+# Expert parameters, excluding the gate weights that stay with the language model.
+_MOE_EXPERT_KEY_PATTERN = re.compile(r"^(?!.*moe\.gate\.wg\.weight).*expert")
+
+
+def _get_attention_mask(seq_length, device, gpu_mask_threshold):
+    """Causal attention mask of size [1, 1, seq_length, seq_length].
+
+    True marks masked positions, matching get_ltor_masks_and_position_ids.
+    Masks of gpu_mask_threshold tokens or more are built on the host and
+    copied over asynchronously to keep construction off the device.
+    """
+    if seq_length < gpu_mask_threshold:
+        attention_mask = torch.ones(seq_length, seq_length, dtype=torch.bool, device=device).triu_(1)
+    else:
+        attention_mask = torch.ones(seq_length, seq_length, dtype=torch.bool).triu_(1)
+        attention_mask = attention_mask.pin_memory().to(device, non_blocking=True)
+    return attention_mask.view(1, 1, seq_length, seq_length)
+
+
 def post_language_model_processing(lm_output, labels, logit_weights,
                                    parallel_output,
-                                   fp16_lm_cross_entropy):
-
-    # Output. Format [s b h]
-    output = parallel_lm_logits(
-        lm_output,
-        logit_weights,
-        parallel_output)
+                                   fp16_lm_cross_entropy,
+                                   cross_entropy):
 
     if labels is None:
-        # [s b h] => [b s h]
-        return output.transpose(0,1).contiguous()
+        # Output. Format [b s h], a view of the [s b h] logits.
+        return parallel_lm_logits(
+            lm_output,
+            logit_weights,
+            parallel_output,
+            seq_first=False)
     else:
-        # [b s] => [s b]
-        labels = labels.transpose(0,1).contiguous()
-        cross_entropy = sequence_parallel.vocab_sequence_parallel_cross_entropy if mpu.get_sequence_parallel_world_size() > 1 \
-            else tensor_parallel.vocab_parallel_cross_entropy
+        # Output. Format [s b h]
+        output = parallel_lm_logits(
+            lm_output,
+            logit_weights,
+            parallel_output)
+
+        # Logits stay [s b h] while labels and loss stay [b s].
         if fp16_lm_cross_entropy:
             assert output.dtype == torch.half
-            loss = cross_entropy(output, labels)
+            loss = cross_entropy(output, labels, seq_first=False)
         else:
-            loss = cross_entropy(output.float(), labels)
-
-        # [s b] => [b, s]
-        loss = loss.transpose(0,1).contiguous()
+            loss = cross_entropy(output, labels, seq_first=False, upcast=True)
         return loss
 
 
@@ -84,6 +138,25 @@ class ChatGLM3Model(MegatronModule):
         self.fp16_lm_cross_entropy = args.fp16_lm_cross_entropy
         self.return_moe_loss = return_moe_loss
         self.untie_embeddings_and_output_weights = args.untie_embeddings_and_output_weights
+        # Only the last stage of a split pipeline keeps its own copy of
+        # the tied word embeddings in checkpoints.
+        self._save_word_embeddings = post_process and not pre_process and \
+            not args.untie_embeddings_and_output_weights
+
+        # Resolved once here rather than on every forward call.
+        self._args = args
+        self._curriculum_learning_legacy = args.curriculum_learning_legacy
+        self._cross_entropy = sequence_parallel.vocab_sequence_parallel_cross_entropy \
+            if mpu.get_sequence_parallel_world_size() > 1 else tensor_parallel.vocab_parallel_cross_entropy
+        self._curriculum_attention_mask = None
+        self._mask_stream = None
+        # Post-processing with every per-model argument bound up front, so
+        # forward only passes the per-microbatch tensors.
+        self._post_language_model_processing = functools.partial(
+            post_language_model_processing,
+            parallel_output=self.parallel_output,
+            fp16_lm_cross_entropy=self.fp16_lm_cross_entropy,
+            cross_entropy=self._cross_entropy)
 
         self.language_model, self._language_model_key = get_language_model(
             config=config,
@@ -97,8 +170,16 @@ class ChatGLM3Model(MegatronModule):
         if not args.untie_embeddings_and_output_weights:
             self.initialize_word_embeddings()
 
+        # Weights allocated above keep standard segments; activations
+        # allocated from here on use expandable segments.
+        if args.use_expandable_segments and torch.cuda.is_available():
+            torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+
     def set_input_tensor(self, input_tensor):
         """See megatron.model.transformer.set_input_tensor()"""
+        # The received activation is used as is. Pipeline schedules keep
+        # several microbatches in flight, so copying them into one shared
+        # receive buffer would overwrite activations still saved for backward.
         self.language_model.set_input_tensor(input_tensor)
 
     def forward(self, input_ids, position_ids, attention_mask,
@@ -107,21 +188,30 @@ class ChatGLM3Model(MegatronModule):
                 retriever_attn_mask=None,
                 labels=None, tokentype_ids=None, inference_params=None,
                 curriculum_seqlen=None):
-        args = get_args()
+        args = self._args
         if curriculum_seqlen is not None:
             args.curriculum_seqlen = curriculum_seqlen
             if curriculum_seqlen < input_ids.size()[1]:
                 # seqlen-based curriculum learning
-                # input_ids, position_ids, labels have size [batch size, seqlen]
-                input_ids = input_ids[:, :curriculum_seqlen].contiguous()
-                position_ids = position_ids[:, :curriculum_seqlen].contiguous()
+                # input_ids, position_ids, labels have size [batch size, seqlen].
+                # Embedding lookups and the cross entropy accept strided
+                # views, so no contiguous copies are made here.
+                input_ids = input_ids[:, :curriculum_seqlen]
+                position_ids = position_ids[:, :curriculum_seqlen]
                 if labels is not None:
-                    labels = labels[:, :curriculum_seqlen].contiguous()
-
-                # attention_mask has size [1, 1, seqlen, seqlen]
-                attention_mask = attention_mask[:, :, :curriculum_seqlen, :curriculum_seqlen].contiguous()
+                    labels = labels[:, :curriculum_seqlen]
+
+                # attention_mask has size [1, 1, seqlen, seqlen]. A plain causal
+                # mask is regenerated at the curriculum length and cached;
+                # document-reset masks are sliced as a view, which the causal
+                # attention path only reads through masked_fill.
+                if attention_mask is not None and not args.reset_attention_mask:
+                    attention_mask = self._get_curriculum_attention_mask(
+                        curriculum_seqlen, attention_mask.device)
+                elif attention_mask is not None:
+                    attention_mask = attention_mask[:, :, :curriculum_seqlen, :curriculum_seqlen]
         else:
-            if args.curriculum_learning_legacy:
+            if self._curriculum_learning_legacy:
                 # If got a None input, need to reset curriculum_seqlen on user side
                 args.curriculum_seqlen = args.seq_length
 
@@ -135,13 +225,32 @@ class ChatGLM3Model(MegatronModule):
             inference_params=inference_params)
 
         if self.post_process:
-            lm_output = post_language_model_processing(
+            lm_output = self._post_language_model_processing(
                 lm_output, labels,
-                self.language_model.output_layer.weight if self.untie_embeddings_and_output_weights else self.shared_embedding_or_output_weight(),
-                self.parallel_output,
-                self.fp16_lm_cross_entropy)
-
-        return lm_output, moe_losses if self.return_moe_loss else lm_output
+                self.language_model.output_layer.weight if self.untie_embeddings_and_output_weights else self.shared_embedding_or_output_weight())
+
+        # (lm_output, moe_losses) when return_moe_loss, otherwise lm_output alone.
+        return (lm_output, moe_losses) if self.return_moe_loss else lm_output
+
+    def _get_curriculum_attention_mask(self, seq_length, device):
+        """Causal mask for seq_length, rebuilt only when the length changes.
+
+        The mask is built on a side stream so that it overlaps with work
+        already queued on the current stream, which waits for it before use.
+        """
+        if self._curriculum_attention_mask is None or \
+                self._curriculum_attention_mask.size(-1) != seq_length:
+            current_stream = get_accelerator().current_stream()
+            if self._mask_stream is None:
+                self._mask_stream = get_accelerator().Stream()
+            with get_accelerator().stream(self._mask_stream):
+                attention_mask = _get_attention_mask(
+                    seq_length, device, self._args.gpu_mask_threshold)
+            current_stream.wait_stream(self._mask_stream)
+            # Allocated on the side stream but read on the current one.
+            attention_mask.record_stream(current_stream)
+            self._curriculum_attention_mask = attention_mask
+        return self._curriculum_attention_mask
 
     def state_dict_for_save_checkpoint(self, prefix='', keep_vars=False):
 
@@ -150,13 +259,10 @@ class ChatGLM3Model(MegatronModule):
                 prefix=prefix, keep_vars=keep_vars)
         # MoE states need to be handled separately by DeepSpeed engine, thus
         # moving them to the top level dictionary
-        if "moe_state_dict" in language_model_state_dict:
-            for key in list(language_model_state_dict["moe_state_dict"].keys()):
-                state_dict_[key] = language_model_state_dict["moe_state_dict"].pop(key)
-            del language_model_state_dict["moe_state_dict"]
+        state_dict_.update(language_model_state_dict.pop("moe_state_dict", {}))
         state_dict_[self._language_model_key] = language_model_state_dict
         # Save word_embeddings.
-        if self.post_process and not self.pre_process and not self.untie_embeddings_and_output_weights:
+        if self._save_word_embeddings:
             state_dict_[self._word_embeddings_for_head_key] \
                 = self.word_embeddings.state_dict(prefix=prefix,
                                                   keep_vars=keep_vars)
@@ -166,14 +272,12 @@ class ChatGLM3Model(MegatronModule):
         """Customized load."""
 
         # Load word_embeddings.
-        if self.post_process and not self.pre_process and not self.untie_embeddings_and_output_weights:
+        if self._save_word_embeddings:
             self.word_embeddings.load_state_dict(
                 state_dict[self._word_embeddings_for_head_key], strict=strict)
         # Gather MoE states and move under language model
-        moe_state_dict = {}
-        for key in list(state_dict.keys()):
-            if 'expert' in key and 'moe.gate.wg.weight' not in key:
-                moe_state_dict[key] = state_dict.pop(key)
+        moe_keys = [key for key in state_dict if _MOE_EXPERT_KEY_PATTERN.search(key)]
+        moe_state_dict = {key: state_dict.pop(key) for key in moe_keys}
         if self._language_model_key in state_dict:
             state_dict = state_dict[self._language_model_key]
         if len(moe_state_dict) > 0:
@@ -184,41 +288,25 @@ class ChatGLM3Model(MegatronModule):
         info = dict()
         if DS_UNIVERSAL_CHECKPOINT_INFO:
             # Vocabulary parameters (embeddings) that require special handling due to padding.
-            info[VOCABULARY_PARAMETER_PATTERNS] = [
-                r"tied_modules.embed.word_embeddings.weight"
-            ]
+            info[VOCABULARY_PARAMETER_PATTERNS] = [_VOCABULARY_PARAMETER_PATTERN]
 
             # Parameter slices that should be averaged not concatenated.
-            info[TP_REPLICATED_PARAMETER_PATTERNS] = [
-                r"tied_modules.embed.position_embeddings.weight",
-                r"\d+.input_layernorm.weight",
-                r"\d+.input_layernorm.bias",
-                r"\d+.post_attention_layernorm.weight",
-                r"\d+.post_attention_layernorm.bias",
-                r"\d+.self_attention.dense.bias",
-                r"\d+.mlp.dense_4h_to_h.bias",
-                r"\d+.weight",
-                r"\d+.bias",
-            ]
+            info[TP_REPLICATED_PARAMETER_PATTERNS] = [_TP_REPLICATED_PARAMETER_PATTERN]
 
             # Parameter that are sliced on the row dimension
-            info[PARAMETER_WITH_ROW_PARALLELISM_PATTERNS] = [
-                r"\d+.mlp.dense_4h_to_h.weight",
-                r"\d+.self_attention.dense.weight",
-            ]
+            info[PARAMETER_WITH_ROW_PARALLELISM_PATTERNS] = [_PARAMETER_WITH_ROW_PARALLELISM_PATTERN]
 
         return info
     
 def CrossEntropy(output, labels):
     labels, loss_mask = labels[0], labels[1]
 
-    args = get_args()
-
-    # [b s] => [s b]
-    labels = labels.transpose(0, 1).contiguous()
-    losses = tensor_parallel.vocab_parallel_cross_entropy(output.contiguous().float(), labels)
-    # [s b] => [b, s]
-    losses = losses.transpose(0, 1).contiguous()
-    loss_mask = loss_mask.view(-1)
-    loss = torch.sum(losses.view(-1) * loss_mask) / loss_mask.sum()
+    # Masked-out tokens are ignored inside the kernel, so their losses are
+    # already zero and no mask product is needed. The labels belong to this
+    # microbatch only and are relabelled in place.
+    labels.masked_fill_(loss_mask == 0, -100)
+    # Logits are [s b h], labels and losses are [b s].
+    losses = tensor_parallel.vocab_parallel_cross_entropy(output.contiguous(), labels, seq_first=False,
+                                                          ignore_index=-100, upcast=True)
+    loss = losses.sum().div_(loss_mask.sum(dtype=torch.float32))
     return loss
@@ -18,8 +18,12 @@ from .utils import init_method_normal, scaled_init_method_normal, gather_and_ini
 
 
 def parallel_lm_logits(input_, word_embeddings_weight, parallel_output,
-                       bias=None):
-    """LM logits using word embedding weights."""
+                       bias=None, seq_first=True):
+    """LM logits using word embedding weights.
+
+    input_ is [s, b, h]. Logits are returned as [s, b, v], or as a
+    [b, s, v] view of the same storage if seq_first is False.
+    """
     args = get_args()
     # Parallel logits.
     if args.async_tensor_model_parallel_allreduce or\
@@ -43,9 +47,13 @@ def parallel_lm_logits(input_, word_embeddings_weight, parallel_output,
     # Gather if needed.
 
     if parallel_output:
-        return logits_parallel
+        logits = logits_parallel
+    else:
+        logits = tensor_parallel.gather_from_tensor_model_parallel_region(logits_parallel)
 
-    return tensor_parallel.gather_from_tensor_model_parallel_region(logits_parallel)
+    if not seq_first:
+        logits = logits.transpose(0, 1)
+    return logits
 
 
 def get_language_model(config, num_tokentypes, add_pooler,
@@ -11,4 +11,37 @@ def test_vocab_parallel_cross_entropy():
     expected_output = torch.tensor([10.2309,  8.2309,  6.2309,  4.2309, 10.2309,  8.2309,  6.2309,  4.2309,
         10.2309,  8.2309,  6.2309,  4.2309, 10.2309,  8.2309,  6.2309,  4.2309]).cuda()
     assert(torch.equal(torch.round(expected_output), torch.round(output)))
-    Utils.destroy_model_parallel()
\ No newline at end of file
+    Utils.destroy_model_parallel()
+
+
+def test_vocab_parallel_cross_entropy_batch_first_target():
+    Utils.initialize_model_parallel(4,2)
+    vocab_parallel_logits = torch.randn(8, 2, 16).cuda()
+    target = torch.randint(0, 16 * 4, (8, 2)).cuda()
+    output = vocab_parallel_cross_entropy(vocab_parallel_logits, target)
+    batch_first_output = vocab_parallel_cross_entropy(vocab_parallel_logits, target.t().contiguous(), seq_first=False)
+    assert(batch_first_output.is_contiguous())
+    assert(torch.allclose(output.t(), batch_first_output))
+    Utils.destroy_model_parallel()
+
+
+def test_vocab_parallel_cross_entropy_ignore_index():
+    Utils.initialize_model_parallel(4,2)
+    vocab_parallel_logits = torch.randn(8, 2, 16).cuda()
+    target = torch.randint(0, 16 * 4, (8, 2)).cuda()
+    target[::2] = -100
+    output = vocab_parallel_cross_entropy(vocab_parallel_logits, target, ignore_index=-100)
+    assert(torch.all(output[::2] == 0))
+    assert(torch.all(output[1::2] > 0))
+    Utils.destroy_model_parallel()
+
+
+def test_vocab_parallel_cross_entropy_upcast():
+    Utils.initialize_model_parallel(4,2)
+    vocab_parallel_logits = torch.randn(8, 2, 16).half().cuda()
+    target = torch.randint(0, 16 * 4, (8, 2)).cuda()
+    output = vocab_parallel_cross_entropy(vocab_parallel_logits.float(), target)
+    upcast_output = vocab_parallel_cross_entropy(vocab_parallel_logits, target, upcast=True)
+    assert(upcast_output.dtype == torch.float32)
+    assert(torch.allclose(output, upcast_output))
+    Utils.destroy_model_parallel()